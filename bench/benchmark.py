@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+
+# Local benchmark of the job submission, dispatch and upload paths.
+#
+# A private nats-server and a wsgidav WebDAV server are started in a
+# scratch directory, the dispatcher.py and worker.py of this tree are
+# run against them as subprocesses, and the results are saved as JSON
+# named after the current commit so that runs can be compared.
+
+import argparse
+import sys
+import os
+import time
+import asyncio
+import json
+import math
+import platform
+import shutil
+import socket
+import subprocess
+import tempfile
+import zipfile
+import nats
+from nats.js.errors import NotFoundError
+
+SRCDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SRCDIR)
+from pkbs import shards, decode
+
+WORKLOADS = {
+    "tiny": "many jobs with a trivial command and no payload",
+    "large": "jobs with a large incompressible zip payload",
+    "files": "jobs writing many output files uploaded with WebDAV",
+}
+
+
+def mylog(message):
+    print(f"{time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime())} {message}")
+    sys.stdout.flush()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_port(port, timeout=30):
+    t = time.time() + timeout
+    while time.time() < t:
+        try:
+            with socket.create_connection(("127.0.0.1", port), 1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"nothing listens on port {port}")
+
+
+def percentile(values, p):
+    """Nearest-rank percentile"""
+    if not values:
+        return None
+    values = sorted(values)
+    k = max(0, math.ceil(p / 100 * len(values)) - 1)
+    return round(values[k], 4)
+
+
+def commit():
+    try:
+        rev = subprocess.check_output(
+            ["git", "-C", SRCDIR, "rev-parse", "--short", "HEAD"],
+            text=True, stderr=subprocess.DEVNULL).strip()
+        dirty = subprocess.call(
+            ["git", "-C", SRCDIR, "diff", "--quiet", "HEAD"],
+            stderr=subprocess.DEVNULL)
+        return f"{rev}-dirty" if dirty else rev
+    except Exception:
+        return "unknown"
+
+
+def make_payload(workdir, name, args):
+    """Returns the payload file of a workload, or None for a command"""
+    if "tiny" == name:
+        return None
+    fname = os.path.join(workdir, f"{name}.zip")
+    with zipfile.ZipFile(fname, "w", zipfile.ZIP_DEFLATED) as z:
+        if "large" == name:
+            z.writestr("run.sh", "#!/bin/sh\nls -l blob > /dev/null\n")
+            z.writestr("blob", os.urandom(args.payload_size))
+        else:
+            z.writestr(
+                "run.sh",
+                "#!/bin/sh\n"
+                f"for i in $(seq {args.files}) ; do\n"
+                f"    head -c {args.file_size} /dev/urandom > out$i.dat\n"
+                "done\n")
+    return fname
+
+
+async def submit(env, queue, upload, payload, args):
+    sem = asyncio.Semaphore(args.concurrency)
+
+    async def dispatch(n):
+        cmd = [sys.executable, os.path.join(SRCDIR, "dispatcher.py"),
+               "-q", queue, "-N", f"bench{n}", "-u", upload]
+        cmd += [payload] if payload else ["-c", "true"]
+        async with sem:
+            p = await asyncio.create_subprocess_exec(
+                *cmd, env=env,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL)
+            out, _ = await p.communicate()
+        if p.returncode:
+            raise RuntimeError(f"dispatcher exited with {p.returncode}")
+        return out.decode().split()[-1]
+
+    t0 = time.time()
+    jobids = await asyncio.gather(*[dispatch(n) for n in range(args.jobs)])
+    return jobids, time.time() - t0
+
+
+def uploaded(webdav_dir, jobid, args):
+    """Returns the upload end time of a job, None if still in progress"""
+    if not os.path.isdir(webdav_dir):
+        return None
+    dirs = [x for x in os.listdir(webdav_dir) if x.endswith(f"-{jobid}")]
+    if not dirs:
+        return None
+    xdir = os.path.join(webdav_dir, dirs[0])
+    outs = [os.path.join(xdir, f"out{i}.dat") for i in range(1, args.files + 1)]
+    if not all(os.path.isfile(x) and os.path.getsize(x) == args.file_size
+               for x in outs):
+        return None
+    return max(os.path.getmtime(x) for x in outs)
+
+
+def span(intervals):
+    """Total time covered by possibly overlapping (start, end) intervals"""
+    total = 0
+    reach = None
+    for start, end in sorted(intervals):
+        if reach is not None:
+            start = max(start, reach)
+        if end > start:
+            total += end - start
+        reach = end if reach is None else max(reach, end)
+    return total
+
+
+async def run_workload(name, nats_url, webdav, workdir, args):
+    queue = f"bench-{name}"
+    upload = "files" if "files" == name else "none"
+    sandbox = os.path.join(workdir, "sandbox", name)
+    os.makedirs(sandbox)
+    env = dict(os.environ)
+    env.update({
+        "NATS_SERVER": nats_url,
+        "QUEUE_SHARDS": str(args.shards),
+        "QSTAT_FORMAT": args.qstat_format,
+        "SANDBOX_DIR": sandbox,
+        "WEBDAV_HOSTNAME": webdav["hostname"],
+        "WEBDAV_ROOT": webdav["root"],
+        "WEBDAV_PATH": "pkbs",
+        "WEBDAV_LOGIN": "bench",
+        "WEBDAV_PASSWORD": "bench",
+    })
+    payload = make_payload(workdir, name, args)
+
+    nc = await nats.connect(nats_url)
+    js = nc.jetstream()
+    jsm = nc.jsm()
+    kv = await js.create_key_value(bucket="qstat")
+
+    workers = []
+    logs = []
+    try:
+        for i in range(args.workers):
+            logs.append(open(os.path.join(workdir, f"{name}-worker-{i}.log"), "w"))
+            workers.append(subprocess.Popen(
+                [sys.executable, os.path.join(SRCDIR, "worker.py"), "-q", queue],
+                env=dict(env, HOSTNAME=f"bench-worker-{i}"),
+                stdout=logs[-1], stderr=subprocess.STDOUT))
+
+        # Workers are ready once their consumer exists on every shard
+        deadline = time.time() + 30
+        for subject, sname in shards(queue, args.shards):
+            while True:
+                try:
+                    await jsm.consumer_info(sname, "workers")
+                    break
+                except NotFoundError:
+                    if time.time() > deadline:
+                        raise RuntimeError("workers did not start")
+                    await asyncio.sleep(0.2)
+
+        mylog(f"Workload {name}: submitting {args.jobs} job(s)")
+        jobids, elapsed = await submit(env, queue, upload, payload, args)
+
+        deadline = time.time() + args.timeout
+        docs = {}
+        ends = {}
+        while len(ends) < len(jobids):
+            if time.time() > deadline:
+                raise RuntimeError(f"workload {name} timed out")
+            for jobid in jobids:
+                if jobid in ends:
+                    continue
+                v = await kv.get(f"{jobid}@{queue}")
+                ji = decode(v.value)
+                if "finished" != ji["status"]:
+                    continue
+                docs[jobid] = ji
+                if "files" == upload:
+                    t = uploaded(os.path.join(webdav["dir"], "pkbs"), jobid, args)
+                    if t:
+                        ends[jobid] = t
+                else:
+                    ends[jobid] = ji["finished"]
+            await asyncio.sleep(0.2)
+    finally:
+        for w in workers:
+            w.terminate()
+        for w in workers:
+            w.wait()
+        for log in logs:
+            log.close()
+        await nc.close()
+
+    latency = [ji["started"] - ji["queued"] for ji in docs.values()]
+    window = max(ends.values()) - min(ji["queued"] for ji in docs.values())
+    result = {
+        "description": WORKLOADS[name],
+        "jobs": len(jobids),
+        "payload_bytes": os.path.getsize(payload) if payload else 0,
+        "submit_seconds": round(elapsed, 4),
+        "submit_rate": round(len(jobids) / elapsed, 2),
+        "queue_to_start_seconds": {
+            "p50": percentile(latency, 50),
+            "p90": percentile(latency, 90),
+            "p99": percentile(latency, 99),
+            "max": percentile(latency, 100),
+        },
+        "jobs_per_second": round(len(jobids) / window, 2),
+        "failed": sum(1 for ji in docs.values() if ji["exit_code"]),
+    }
+    if "files" == upload:
+        # Each job uploads from its finish until its last output file lands,
+        # the uploads of concurrent workers are counted once over their span
+        nbytes = len(jobids) * args.files * args.file_size
+        seconds = span((docs[x]["finished"], ends[x]) for x in jobids)
+        result["upload_bytes"] = nbytes
+        result["upload_seconds"] = round(seconds, 4)
+        result["upload_mb_per_second"] = round(nbytes / 1e6 / seconds, 2) if seconds else None
+    return result
+
+
+def compare(results, baseline):
+    with open(baseline) as fp:
+        base = json.load(fp)
+    print(f"Compared to {base['commit']} ({baseline})")
+    for name, r in results["workloads"].items():
+        b = base["workloads"].get(name)
+        if not b:
+            continue
+        for key in ["submit_rate", "jobs_per_second", "upload_mb_per_second"]:
+            if r.get(key) and b.get(key):
+                print(f"  {name:<6} {key:<21} {b[key]:>10} -> {r[key]:>10}"
+                      f" ({100 * (r[key] / b[key] - 1):+.1f}%)")
+        x = b["queue_to_start_seconds"]["p50"]
+        y = r["queue_to_start_seconds"]["p50"]
+        if x and y:
+            print(f"  {name:<6} {'queue_to_start_p50':<21} {x:>10} -> {y:>10}"
+                  f" ({100 * (y / x - 1):+.1f}%)")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--baseline', default=None,
+                        help="earlier result file to compare with")
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help="number of dispatchers run in parallel")
+    parser.add_argument('--file-size', type=int, default=256 * 1024)
+    parser.add_argument('--files', type=int, default=20,
+                        help="output files per job in the files workload")
+    parser.add_argument('-j', '--jobs', type=int, default=100)
+    parser.add_argument('--keep', action="store_true", default=False,
+                        help="keep the scratch directory and logs")
+    parser.add_argument('--nats-server',
+                        default=shutil.which("nats-server") or
+                        os.path.join(SRCDIR, "nats-server"))
+    parser.add_argument('-o', '--output', default=None)
+    parser.add_argument('--payload-size', type=int, default=900000)
+    parser.add_argument('--qstat-format', choices=["json", "msgpack"],
+                        default="json")
+    parser.add_argument('--shards', type=int, default=1)
+    parser.add_argument('--timeout', type=int, default=600)
+    parser.add_argument('-w', '--workloads', default=",".join(WORKLOADS))
+    parser.add_argument('--workers', type=int, default=2)
+    args = parser.parse_args()
+
+    names = [x for x in args.workloads.split(",") if x]
+    for name in names:
+        if name not in WORKLOADS:
+            mylog(f"Error: unknown workload {name}")
+            sys.exit(1)
+
+    if not os.access(args.nats_server, os.X_OK):
+        mylog("Error: nats-server not found, try make nats-server")
+        sys.exit(1)
+
+    if "files" in names and not shutil.which("wsgidav"):
+        mylog("Error: wsgidav not found, see bench/requirements.txt")
+        sys.exit(1)
+
+    workdir = tempfile.mkdtemp(prefix="pkbs-bench-")
+    procs = []
+    try:
+        port = free_port()
+        procs.append(subprocess.Popen(
+            [args.nats_server, "-a", "127.0.0.1", "-p", str(port), "-js",
+             "-sd", os.path.join(workdir, "jetstream")],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+        wait_port(port)
+        nats_url = f"nats://127.0.0.1:{port}"
+
+        webdav = {"dir": os.path.join(workdir, "webdav", "bench"),
+                  "hostname": "", "root": "/bench"}
+        os.makedirs(webdav["dir"])
+        if "files" in names:
+            port = free_port()
+            procs.append(subprocess.Popen(
+                ["wsgidav", "--host", "127.0.0.1", "--port", str(port),
+                 "--root", os.path.dirname(webdav["dir"]),
+                 "--auth", "anonymous", "-q"],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+            wait_port(port)
+            webdav["hostname"] = f"http://127.0.0.1:{port}"
+
+        results = {
+            "commit": commit(),
+            "date": time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime()),
+            "host": {
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+            },
+            "parameters": {k: v for k, v in vars(args).items()
+                           if k not in ["baseline", "keep", "output"]},
+            "workloads": {},
+        }
+        for name in names:
+            r = await run_workload(name, nats_url, webdav, workdir, args)
+            results["workloads"][name] = r
+            mylog(f"Workload {name}: {json.dumps(r)}")
+    finally:
+        for p in procs:
+            p.terminate()
+            p.wait()
+        if args.keep:
+            mylog(f"Scratch directory {workdir} is kept")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = args.output or f"bench-{results['commit']}.json"
+    with open(output, "w") as fp:
+        json.dump(results, fp, indent=4)
+    mylog(f"Results saved to {output}")
+
+    if args.baseline:
+        compare(results, args.baseline)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -17,6 +17,7 @@
 #
 
 import argparse
+import io
 import os
 import sys
 import time
@@ -24,10 +25,13 @@ import asyncio
 import nats
 import nanoid
 from nats.errors import TimeoutError
-import json
+from nats.js.errors import KeyNotFoundError
 import logging
 from logging.handlers import SysLogHandler
 import socket
+import zlib
+import zipfile
+from pkbs import shards, encode, record
 
 cfg = {
     "logger": None
@@ -50,6 +54,17 @@ def mylog(message, stdout=True):
         cfg["logger"].info(message)
 
 
+def shell_script(data):
+    """True if the shebang of a script names a shell interpreter"""
+    if not data.startswith(b"#!"):
+        return False
+    words = data[2:].split(b"\n", 1)[0].decode("utf-8", "replace").split()
+    if words and "env" == os.path.basename(words[0]):
+        # Skip the options and variable assignments of env
+        words = [x for x in words[1:] if not x.startswith("-") and "=" not in x]
+    return bool(words) and os.path.basename(words[0]) in ["sh", "bash", "dash", "ksh", "zsh"]
+
+
 async def main(argv):
     parser = argparse.ArgumentParser()
     parser.add_argument('-a', '--webdav-hostname', default=None)
@@ -73,6 +88,16 @@ async def main(argv):
     parser.add_argument('-F', '--files-from', default=None)
     parser.add_argument('-f', '--fixed-path', default=None)
     parser.add_argument('-q', '--queue', default="jobs")
+    parser.add_argument(
+        '--qstat-format',
+        choices=["json", "msgpack"],
+        default=os.getenv("QSTAT_FORMAT", "json"),
+        help="encoding of the job records written to the qstat bucket")
+    parser.add_argument(
+        '--shards',
+        type=int,
+        default=int(os.getenv("QUEUE_SHARDS", "1")),
+        help="number of subjects and streams the queue is spread over")
     parser.add_argument(
         '-s',
         '--servers',
@@ -92,6 +117,12 @@ async def main(argv):
             "files"),
         help="one of files, none, or zip")
     parser.add_argument('--token', default="")
+    parser.add_argument(
+        '-W',
+        '--attributes',
+        action="append",
+        default=[],
+        help="job attributes, e.g. depend=afterok:<jobid>[:<jobid>...]")
     parser.add_argument("file", metavar="FILE", type=str, nargs='?')
     args, unknown = parser.parse_known_args()
 
@@ -153,6 +184,12 @@ async def main(argv):
                 data = fp.read()
             headers["filename"] = os.path.basename(args.file)
             headers["command"] = args.command
+            # Declare the payload type so that workers need not sniff it,
+            # anything else is left for the workers to identify
+            if zipfile.is_zipfile(io.BytesIO(data)):
+                headers["payload"] = "zip"
+            elif shell_script(data):
+                headers["payload"] = "sh"
         else:
             mylog(f"Error: file {args.file} not found.")
             sys.exit(1)
@@ -162,6 +199,16 @@ async def main(argv):
         # FIXME
         sys.exit(1)
 
+    afterok = []
+    for attribute in args.attributes:
+        key, _, value = attribute.partition("=")
+        ids = [x for x in value.split(":")[1:] if x]
+        if "depend" == key and value.startswith("afterok:") and ids:
+            afterok += ids
+        else:
+            mylog(f"Error: unsupported job attribute {attribute}")
+            sys.exit(1)
+
     if args.files_from:
         headers["files-from"] = args.files_from
 
@@ -197,21 +244,46 @@ async def main(argv):
 
     # Record the job in the key-value store
     kv = await js.create_key_value(bucket="qstat")
-    doc = {
-        "queued": time.time(),
-        "started": None,
-        "finished": None,
-        "name": args.name,
-        "status": "queued",
-        "node": None,
-        "exit_code": None,
-        "wallclock": None
-    }
-    await kv.put(f'{jobid}@{args.queue}', json.dumps(doc).encode('utf-8'))
 
-    # Publish message to the jobs queue (i.e, a subject in Jetstream)
-    await js.add_stream(name=f"{args.queue}-stream", subjects=[args.queue])
-    ack = await js.publish(args.queue, data, headers=headers)
+    # Dependencies must refer to jobs already known in the same queue
+    async def known(parent):
+        try:
+            await kv.get(f"{parent}@{args.queue}")
+            return True
+        except KeyNotFoundError:
+            return False
+
+    for parent, found in zip(afterok, await asyncio.gather(*[known(x) for x in afterok])):
+        if not found:
+            mylog(f"Error: dependency {parent} not found in queue {args.queue}")
+            await nc.close()
+            sys.exit(1)
+
+    doc = record(args.name, time.time(), "held" if afterok else "queued")
+
+    if afterok:
+        # Park the job on the held subject before it becomes visible as held
+        # in the key-value store, the scheduler releases it to the queue once
+        # all of its dependencies have finished ok
+        doc["afterok"] = afterok
+        await js.add_stream(name=f"{args.queue}-held-stream",
+                            subjects=[f"{args.queue}-held.*"])
+        ack = await js.publish(f"{args.queue}-held.{jobid}", data, headers=headers)
+        await kv.create(f'{jobid}@{args.queue}', encode(doc, args.qstat_format))
+    else:
+        revision = await kv.create(f'{jobid}@{args.queue}', encode(doc, args.qstat_format))
+
+        # The worker picks the record up from the headers instead of
+        # reading it back before its first update
+        headers["queued"] = str(doc["queued"])
+        headers["revision"] = str(revision)
+
+        # Publish message to the jobs queue (i.e, a subject in Jetstream),
+        # a sharded queue is spread over its subjects by the job id hash
+        subjects = shards(args.queue, args.shards)
+        subject, sname = subjects[zlib.crc32(jobid.encode()) % len(subjects)]
+        await js.add_stream(name=sname, subjects=[subject])
+        ack = await js.publish(subject, data, headers=headers)
 
     await nc.close()
 
@@ -0,0 +1,39 @@
+# Helpers shared by the dispatcher, scheduler, worker and qstat
+
+import json
+import msgpack
+
+
+def shards(queue, n):
+    """Subjects and streams of a queue partitioned into n shards"""
+    if n <= 1:
+        return [(queue, f"{queue}-stream")]
+    return [(f"{queue}.{i}", f"{queue}-stream-{i}") for i in range(n)]
+
+
+def encode(doc, fmt="json"):
+    """Job record as stored in the qstat key-value bucket"""
+    if "msgpack" == fmt:
+        return msgpack.packb(doc)
+    return json.dumps(doc, separators=(",", ":")).encode("utf-8")
+
+
+def decode(value):
+    """Job record from the qstat key-value bucket, either encoding"""
+    if value[:1] == b"{":
+        return json.loads(value.decode("utf-8"))
+    return msgpack.unpackb(value)
+
+
+def record(name, queued, status="queued"):
+    """Job record of a newly submitted job"""
+    return {
+        "queued": queued,
+        "started": None,
+        "finished": None,
+        "name": name,
+        "status": status,
+        "node": None,
+        "exit_code": None,
+        "wallclock": None
+    }
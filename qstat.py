@@ -26,6 +26,7 @@ import nats
 from nats.errors import TimeoutError
 from nats.js.errors import NotFoundError
 import json
+from pkbs import shards, decode
 
 
 def mylog(message):
@@ -39,6 +40,11 @@ async def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--creds', default="")
     parser.add_argument('-q', '--queue', default="jobs")
+    parser.add_argument(
+        '--shards',
+        type=int,
+        default=int(os.getenv("QUEUE_SHARDS", "1")),
+        help="number of subjects and streams the queue is spread over")
     parser.add_argument(
         '-s',
         '--servers',
@@ -86,56 +92,67 @@ async def main():
         sys.exit(1)
 
     consumer = f"workers"
-    sname = f"{args.queue}-stream"
+    subjects = shards(args.queue, args.shards)
 
     # Create JetStream context.
     js = nc.jetstream()
 
-    # Persist messages on jobs' queue (i.e, subject in Jetstream).
-    await js.add_stream(name=sname, subjects=[args.queue])
-    s = await jsm.stream_info(sname)
-    try:
-        c = await jsm.consumer_info(sname, consumer)
-        num_pending = c.num_pending
-    except NotFoundError:
-        num_pending = 0
-        pass
-    except Exception as e:
-        print(e)
-        num_pending = -1
+    # A sharded queue is reported as one, summed over its streams
+    messages = 0
+    num_pending = 0
+    for subject, sname in subjects:
+        # Persist messages on jobs' queue (i.e, subject in Jetstream).
+        await js.add_stream(name=sname, subjects=[subject])
+        s = await jsm.stream_info(sname)
+        messages += s.state.messages
+        c = None
+        try:
+            c = await jsm.consumer_info(sname, consumer)
+            if num_pending >= 0:
+                num_pending += c.num_pending
+        except NotFoundError:
+            pass
+        except Exception as e:
+            print(e)
+            num_pending = -1
 
-    if args.verbose:
-        print(s)
-        print(c)
-    print(f"{s.config.name} messages {s.state.messages} pending {num_pending}")
+        if args.verbose:
+            print(s)
+            print(c)
+    print(f"{args.queue}-stream messages {messages} pending {num_pending}")
 
     # Replay messages in queue
-    await js.add_stream(name=sname, subjects=[args.queue])
-
-    cinfo = await js.add_consumer(
-        sname,
-        durable_name="qstat",
-        deliver_policy=nats.js.api.DeliverPolicy.ALL,
-        filter_subject=args.queue
-    )
+    for subject, sname in subjects:
+        cinfo = await js.add_consumer(
+            sname,
+            durable_name="qstat",
+            deliver_policy=nats.js.api.DeliverPolicy.ALL,
+            filter_subject=subject
+        )
+
+    # Jobs waiting for their dependencies are parked on a separate stream
+    hname = f"{args.queue}-held-stream"
+    await js.add_stream(name=hname, subjects=[f"{args.queue}-held.*"])
 
     jobs = []
-    sub = await js.subscribe(args.queue, stream=sname)
-    while True:
-        try:
-            msg = await sub.next_msg()
-            jobid = msg.headers["jobid"]
-            jobs.append(jobid)
-        except nats.errors.TimeoutError:
-            # Reached apparent end of stream
-            break
-        except Exception as e:
-            print(e)
+    for subject, stream in subjects + [(f"{args.queue}-held.*", hname)]:
+        sub = await js.subscribe(subject, stream=stream)
+        while True:
+            try:
+                msg = await sub.next_msg()
+                jobid = msg.headers["jobid"]
+                jobs.append(jobid)
+            except nats.errors.TimeoutError:
+                # Reached apparent end of stream
+                break
+            except Exception as e:
+                print(e)
+        await sub.unsubscribe()
 
     kv = await js.create_key_value(bucket="qstat")
     for jobid in jobs:
         v = await kv.get(f"{jobid}@{args.queue}")
-        ji = json.loads(v.value.decode("utf-8"))
+        ji = decode(v.value)
         if args.verbose:
             print(json.dumps(ji, indent=4))
         else:
@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+
+# Source: napts.py/examples/jetstream.py
+
+# Copyright 2016-2019 The NATS Authors
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import argparse
+import os
+import sys
+import time
+import asyncio
+import nats
+from nats.errors import TimeoutError
+from nats.js.errors import APIError, KeyWrongLastSequenceError, NotFoundError
+import logging
+from logging.handlers import SysLogHandler
+import socket
+import zlib
+from pkbs import shards, encode, decode
+
+cfg = {
+    "logger": None
+}
+
+
+class ContextFilter(logging.Filter):
+    hostname = socket.gethostname()
+
+    def filter(self, record):
+        record.hostname = ContextFilter.hostname
+        return True
+
+
+def mylog(message, stdout=True):
+    if stdout:
+        print(f"{time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime())} {message}")
+        sys.stdout.flush()
+    if cfg["logger"]:
+        cfg["logger"].info(message)
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--creds', default="")
+    parser.add_argument('-q', '--queue', default="jobs")
+    parser.add_argument(
+        '--qstat-format',
+        choices=["json", "msgpack"],
+        default=os.getenv("QSTAT_FORMAT", "json"),
+        help="encoding of the job records written to the qstat bucket")
+    parser.add_argument(
+        '--shards',
+        type=int,
+        default=int(os.getenv("QUEUE_SHARDS", "1")),
+        help="number of subjects and streams the queue is spread over")
+    parser.add_argument(
+        '-s',
+        '--servers',
+        default=os.getenv(
+            "NATS_SERVER",
+            "nats-svc"))
+    parser.add_argument(
+        "--syslog",
+        action="store_true",
+        dest="syslog",
+        default=False)
+    parser.add_argument('--token', default="")
+    args, unknown = parser.parse_known_args()
+
+    if args.syslog:
+        try:
+            address = (
+                os.getenv(
+                    "RSYSLOG_SERVER",
+                    "rsyslog-svc.pkbs-system"),
+                514)
+            syslog = SysLogHandler(address=address)
+            syslog.addFilter(ContextFilter())
+            fmt = "%(asctime)s %(hostname)s %(message)s"
+            formatter = logging.Formatter(fmt, datefmt='%b %d %H:%M:%S')
+            syslog.setFormatter(formatter)
+            logger = logging.getLogger()
+            logger.addHandler(syslog)
+            logger.setLevel(logging.INFO)
+            cfg["logger"] = logger
+        except Exception as e:
+            # Keep calm and carry on without syslog
+            pass
+
+    async def error_cb(e):
+        # mylog("Error:", e)
+        pass
+
+    async def reconnected_cb():
+        mylog(f"Connected to NATS at {nc.connected_url.netloc}...")
+
+    options = {
+        "error_cb": error_cb,
+        "reconnected_cb": reconnected_cb
+    }
+
+    if len(args.creds) > 0:
+        options["user_credentials"] = args.creds
+
+    if args.token.strip() != "":
+        options["token"] = args.token.strip()
+
+    try:
+        if len(args.servers) > 0:
+            options['servers'] = args.servers
+
+        nc = await nats.connect(**options)
+        jsm = nc.jsm()
+    except Exception as e:
+        mylog(e)
+        sys.exit(1)
+
+    subjects = shards(args.queue, args.shards)
+    hname = f"{args.queue}-held-stream"
+    suffix = f"@{args.queue}"
+
+    # Create JetStream context
+    js = nc.jetstream()
+
+    # Held jobs are parked on their own subject until released
+    for subject, sname in subjects:
+        await js.add_stream(name=sname, subjects=[subject])
+    await js.add_stream(name=hname, subjects=[f"{args.queue}-held.*"])
+    kv = await js.create_key_value(bucket="qstat")
+
+    # Dependency bookkeeping, keyed by job id:
+    #   done     - terminal jobs, True if the job finished with exit code 0
+    #   waiting  - held jobs and the set of parents they still wait for
+    #   children - parents and the held jobs that wait for them
+    # Every finished parent is then resolved in O(number of its children)
+    # no matter how many parents a job fans in from.
+    done = {}
+    waiting = {}
+    children = {}
+    # Held jobs whose release or abort failed, retried periodically
+    stranded = set()
+
+    async def jobinfo(jobid):
+        v = await kv.get(f"{jobid}{suffix}")
+        return decode(v.value), v.revision
+
+    async def transition(jobid, ji, revision, changes):
+        # Compare-and-swap on the record revision so that a job is released
+        # or aborted only once, and only while it is still held
+        for _ in range(10):
+            if "held" != ji.get("status"):
+                return False
+            ji.update(changes)
+            try:
+                await kv.update(f"{jobid}{suffix}", encode(ji, args.qstat_format), last=revision)
+                return True
+            except KeyWrongLastSequenceError:
+                ji, revision = await jobinfo(jobid)
+        mylog(f"Error: job {jobid} record was not updated, too many conflicts")
+        return False
+
+    async def drop(jobid, seq=None):
+        # Remove the held payload, possibly done already by another replica
+        try:
+            if seq is None:
+                msg = await jsm.get_last_msg(hname, f"{args.queue}-held.{jobid}")
+                seq = msg.seq
+            await jsm.delete_msg(hname, seq)
+        except APIError:
+            pass
+
+    async def release(jobid, ji, revision):
+        subject = f"{args.queue}-held.{jobid}"
+        try:
+            msg = await jsm.get_last_msg(hname, subject)
+        except NotFoundError:
+            mylog(f"Error: held job {jobid} has no payload on {subject}")
+            return
+        # Publish before the record says queued so that a crash in between
+        # leaves the job held and released again, the message id makes the
+        # stream drop such a repeated release as a duplicate
+        headers = dict(msg.headers or {})
+        headers["Nats-Msg-Id"] = jobid
+        queue, _ = subjects[zlib.crc32(jobid.encode()) % len(subjects)]
+        await js.publish(queue, msg.data or b"", headers=headers)
+        if not await transition(jobid, ji, revision, {"status": "queued", "queued": time.time()}):
+            mylog(f"Job {jobid} was no longer held when released")
+        await drop(jobid, msg.seq)
+        mylog(f"Job {jobid} released")
+
+    async def abort(jobid, ji, revision, parent):
+        if await transition(jobid, ji, revision, {"status": "aborted", "finished": time.time()}):
+            await drop(jobid)
+            mylog(f"Job {jobid} aborted, dependency {parent} did not finish ok")
+
+    async def resolve(jobid, parent, ok):
+        if jobid not in waiting:
+            return
+        if ok:
+            waiting[jobid].discard(parent)
+            if waiting[jobid]:
+                return
+        del waiting[jobid]
+        try:
+            if ok:
+                await release(jobid, *await jobinfo(jobid))
+            else:
+                await abort(jobid, *await jobinfo(jobid), parent)
+        except Exception as e:
+            mylog(f"Error: job {jobid} was not settled, retrying later: {e}")
+            stranded.add(jobid)
+
+    async def retry():
+        # A held job is settled again from its current record
+        for jobid in list(stranded):
+            stranded.discard(jobid)
+            try:
+                await update(jobid, *await jobinfo(jobid))
+            except Exception as e:
+                mylog(f"Error: job {jobid} was not settled, retrying later: {e}")
+                stranded.add(jobid)
+
+    async def recover():
+        # Payloads left on the held stream by a release that was cut short.
+        # A queued record may predate publishing the job, which is published
+        # again (a duplicate is dropped by its message id), the payloads of
+        # jobs that have moved on further are merely removed.
+        sub = await js.subscribe(f"{args.queue}-held.*", stream=hname)
+        leftovers = []
+        while True:
+            try:
+                msg = await sub.next_msg()
+            except nats.errors.TimeoutError:
+                break
+            leftovers.append(msg.subject.split(".")[-1])
+        await sub.unsubscribe()
+        for jobid in leftovers:
+            try:
+                ji, revision = await jobinfo(jobid)
+                if "held" == ji.get("status"):
+                    continue
+                msg = await jsm.get_last_msg(hname, f"{args.queue}-held.{jobid}")
+                if "queued" == ji.get("status"):
+                    headers = dict(msg.headers or {})
+                    headers["Nats-Msg-Id"] = jobid
+                    queue, _ = subjects[zlib.crc32(jobid.encode()) % len(subjects)]
+                    await js.publish(queue, msg.data or b"", headers=headers)
+                    mylog(f"Job {jobid} released again")
+                await drop(jobid, msg.seq)
+            except Exception as e:
+                mylog(f"Error: held payload of job {jobid} not recovered: {e}")
+
+    async def update(jobid, ji, revision):
+        status = ji.get("status")
+        if status in ["finished", "aborted"]:
+            if jobid in done:
+                return
+            ok = "finished" == status and 0 == ji.get("exit_code")
+            done[jobid] = ok
+            for child in children.pop(jobid, []):
+                await resolve(child, jobid, ok)
+        elif "held" == status and jobid not in waiting:
+            pending = set()
+            for parent in ji.get("afterok", []):
+                if parent in done:
+                    if not done[parent]:
+                        await abort(jobid, ji, revision, parent)
+                        return
+                else:
+                    pending.add(parent)
+            if pending:
+                waiting[jobid] = pending
+                for parent in pending:
+                    children.setdefault(parent, []).append(jobid)
+            else:
+                await release(jobid, ji, revision)
+
+    # The initial pass replays the latest state of every job, after which
+    # the watcher delivers each transition as it is written
+    watcher = await kv.watchall()
+    mylog(f"Watching held jobs of queue {args.queue}")
+    recovered = False
+    retried = time.time()
+    while True:
+        try:
+            entry = await watcher.updates(timeout=10)
+        except nats.errors.TimeoutError:
+            entry = False
+        if stranded and time.time() - retried > 10:
+            await retry()
+            retried = time.time()
+        if entry is False:
+            continue
+        if not entry:
+            if not recovered:
+                await recover()
+                recovered = True
+            mylog(f"There are {len(waiting)} held job(s)")
+            continue
+        if entry.operation or not entry.key.endswith(suffix):
+            continue
+        jobid = entry.key[:-len(suffix)]
+        try:
+            await update(jobid, decode(entry.value), entry.revision)
+        except Exception as e:
+            mylog(f"Error: job {jobid} update failed, retrying later: {e}")
+            stranded.add(jobid)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
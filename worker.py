@@ -19,24 +19,28 @@
 import argparse
 import sys
 import os
+import stat
 import time
 import asyncio
 import nats
 import magic
 from nats.errors import TimeoutError
+from nats.js.errors import KeyWrongLastSequenceError
 from zipfile import ZIP_DEFLATED, ZipFile
+from io import BytesIO
 from pathlib import Path
 from typing import Union
 import hashlib
 import requests
-import json
 import nanoid
 from shutil import rmtree
 import logging
 from logging.handlers import SysLogHandler
 import socket
+import zlib
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 from uwebdavclient.client import Client
+from pkbs import shards, encode, decode, record
 
 
 cfg = {
@@ -69,11 +73,60 @@ def zip_dir(zip_name: str, source_dir: Union[str, os.PathLike]):
             zf.write(file, file.relative_to(src_path.parent))
 
 
+def unzip(data: bytes, dest: Union[str, os.PathLike], limit: int = 0):
+    # Extract straight from memory, restoring the permission bits kept in
+    # the upper half of the external attributes by Unix zip tools
+    with ZipFile(BytesIO(data), "r") as z:
+        members = z.infolist()
+        size = sum(m.file_size for m in members)
+        if limit and size > limit:
+            raise ValueError(f"{size} bytes exceeds the sandbox size {limit}")
+        for m in members:
+            path = z.extract(m, dest)
+            mode = (m.external_attr >> 16) & 0o777
+            if mode and not m.is_dir():
+                os.chmod(path, mode)
+
+
+def zip_command(sandbox, command, ofile, efile, runfile="run.sh"):
+    """Command running an unpacked payload, None if there is nothing to run"""
+    if command:
+        script = os.path.join(sandbox, command)
+        if os.path.isfile(script) and not os.access(script, os.X_OK):
+            # Archive made without Unix attributes
+            os.chmod(script, os.stat(script).st_mode | stat.S_IXUSR)
+        return f"cd {sandbox} && ./{command} > {ofile} 2> {efile}"
+    if not os.path.isfile(os.path.join(sandbox, runfile)):
+        return None
+    return f"cd {sandbox} && /bin/sh {runfile} > {ofile} 2> {efile}"
+
+
 async def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--creds', default="")
     parser.add_argument('--max-jobs', default=None)
     parser.add_argument('-q', '--queue', default="jobs")
+    parser.add_argument(
+        '--sandbox-dir',
+        default=os.getenv(
+            "SANDBOX_DIR",
+            "/var/tmp/pkbs"),
+        help="where job sandboxes are created, e.g. a tmpfs mount")
+    parser.add_argument(
+        '--sandbox-size',
+        type=int,
+        default=int(os.getenv("SANDBOX_SIZE", "0")),
+        help="maximum unpacked payload size in bytes, 0 for no limit")
+    parser.add_argument(
+        '--qstat-format',
+        choices=["json", "msgpack"],
+        default=os.getenv("QSTAT_FORMAT", "json"),
+        help="encoding of the job records written to the qstat bucket")
+    parser.add_argument(
+        '--shards',
+        type=int,
+        default=int(os.getenv("QUEUE_SHARDS", "1")),
+        help="number of subjects and streams the queue is spread over")
     parser.add_argument(
         '-s',
         '--servers',
@@ -136,21 +189,41 @@ async def main():
         sys.exit(1)
 
     consumer = "workers"
-    sname = f"{args.queue}-stream"
+    subjects = shards(args.queue, args.shards)
 
     # Create JetStream context
     js = nc.jetstream()
 
     # Persist messages on jobs' queue (i.e, subject in Jetstream).
-    await js.add_stream(name=sname, subjects=[args.queue])
+    for subject, sname in subjects:
+        await js.add_stream(name=sname, subjects=[subject])
     kv = await js.create_key_value(bucket="qstat")
 
-    async def jobinfo(jobid, doc=None):
-        if doc:
-            await kv.put(f'{jobid}@{args.queue}', json.dumps(doc).encode("utf-8"))
-        else:
-            v = await kv.get(f"{jobid}@{args.queue}")
-            return json.loads(v.value.decode("utf-8"))
+    # Job records this worker has written, with their revisions, so that the
+    # next transition of the same job needs no read
+    records = {}
+
+    async def jobinfo(jobid, expected, changes):
+        # Compare-and-swap on the record revision, another actor having
+        # written it in between means re-reading it and trying again as
+        # long as the job is still in one of the expected states
+        key = f"{jobid}@{args.queue}"
+        ji, revision = records.get(jobid, (None, None))
+        for _ in range(10):
+            if ji is None:
+                v = await kv.get(key)
+                ji, revision = decode(v.value), v.revision
+            if ji.get("status") not in expected:
+                mylog(f"Error: job {jobid} is {ji.get('status')}, not {' or '.join(expected)}")
+                return None
+            ji.update(changes)
+            try:
+                revision = await kv.update(key, encode(ji, args.qstat_format), last=revision)
+                records[jobid] = (ji, revision)
+                return ji
+            except KeyWrongLastSequenceError:
+                ji = None
+        mylog(f"Error: job {jobid} record was not updated, too many conflicts")
 
     def tempname():
         return os.path.join(
@@ -167,6 +240,7 @@ async def main():
         name = msg.headers.get("name", "")
         filename = msg.headers.get("filename")
         command = msg.headers.get("command")
+        payload = msg.headers.get("payload")
         fixed_path = msg.headers.get("fixed-path")  # FIXME
         upload = msg.headers.get("upload", os.getenv("WEBDAV_UPLOAD", "files")).lower()
         webdav_hostname = msg.headers.get("webdav-hostname", os.getenv(
@@ -187,6 +261,11 @@ async def main():
             mylog("Jobs without jobid item in header will not be processed")
             return
 
+        if msg.headers.get("revision"):
+            records[jobid] = (
+                record(name, float(msg.headers["queued"])),
+                int(msg.headers["revision"]))
+
         if upload in ["zip", "files"]:
             mylog(f"Upload {upload}")
             webdav_options = {
@@ -199,7 +278,7 @@ async def main():
             }
             webdav = Client(webdav_options)
 
-        sandbox = os.path.join("/var", "tmp", "pkbs", jobid)
+        sandbox = os.path.join(args.sandbox_dir, jobid)
         tmpdir = tempname()
         nodefile = tempname()
 
@@ -222,7 +301,53 @@ async def main():
             f" TMPDIR={tmpdir}"
         )
 
-        if filename:
+        def cleanup():
+            if os.path.isfile(nodefile):
+                os.unlink(nodefile)
+
+            if os.path.isdir(tmpdir):
+                rmtree(tmpdir)
+
+            if os.path.isdir(sandbox):
+                rmtree(sandbox)
+
+        async def reject(reason):
+            # Finish the job without running it, so that jobs depending on
+            # it are aborted rather than held forever
+            mylog(f"Error: job {jobid} is rejected, {reason}")
+            t = time.time()
+            await jobinfo(jobid, ["queued", "held"], {
+                "started": t,
+                "finished": t,
+                "status": "finished",
+                "node": os.getenv("HOSTNAME", "UNDEFINED"),
+                "exit_code": -1,
+                "wallclock": 0,
+            })
+            records.pop(jobid, None)
+            cleanup()
+
+        if filename and payload in ["zip", "sh"]:
+            ofile = "stdout.txt"
+            efile = "stderr.txt"
+            os.makedirs(sandbox)
+            if "sh" == payload:
+                with open(os.path.join(sandbox, filename), "wb") as fp:
+                    fp.write(msg.data)
+                mylog(f"Payload '{payload}' cached to {sandbox}")
+                command = f"cd {sandbox} && /bin/sh {filename} > {ofile} 2> {efile}"
+            else:
+                try:
+                    unzip(msg.data, sandbox, args.sandbox_size)
+                except Exception as e:
+                    await reject(f"payload cannot be extracted: {e}")
+                    return
+                mylog(f"Payload '{payload}' extracted to {sandbox}")
+                command = zip_command(sandbox, command, ofile, efile)
+                if not command:
+                    await reject("file run.sh is not found")
+                    return
+        elif filename:
             ofile = "stdout.txt"
             efile = "stderr.txt"
             os.makedirs(sandbox)
@@ -234,34 +359,36 @@ async def main():
             if ftype in ["text/x-sh", "text/x-shellscript"]:
                 command = f"cd {sandbox} && /bin/sh {filename} > {ofile} 2> {efile}"
             elif "application/zip" == ftype:
-                with ZipFile(fname, "r") as z:
-                    z.extractall(sandbox)
                 os.unlink(fname)
-                if command:
-                    # Python ZipFile rudely trashes executable permissions
-                    command = f"cd {sandbox} && chmod u+x {command} && ./{command} > {ofile} 2> {efile}"
-                else:
-                    runfile = "run.sh"
-                    script = os.path.join(sandbox, runfile)
-                    if not(os.path.isfile(script)):
-                        mylog(f"Error: file {runfile} is not found")
-                        return
-                    command = f"cd {sandbox} && /bin/sh {runfile} > {ofile} 2> {efile}"
+                try:
+                    unzip(msg.data, sandbox, args.sandbox_size)
+                except Exception as e:
+                    await reject(f"payload cannot be extracted: {e}")
+                    return
+                command = zip_command(sandbox, command, ofile, efile)
+                if not command:
+                    await reject("file run.sh is not found")
+                    return
             else:
-                mylog(f"Error: payload file type {ftype} is unsupported")
+                await reject(f"payload file type {ftype} is unsupported")
                 return
         else:
             command = msg.data.decode("utf-8")
 
         mylog(f"Job {jobid} command is: {command}")
 
-        # Update job info: started
-        ji = await jobinfo(jobid)
+        # Update job info: started. A released job may still be recorded as
+        # held, a job in any other state is run by someone else already.
         t1 = time.time()
-        ji["started"] = t1
-        ji["status"] = "running"
-        ji["node"] = os.getenv("HOSTNAME", "UNDEFINED")
-        await jobinfo(jobid, ji)
+        if not await jobinfo(jobid, ["queued", "held"], {
+            "started": t1,
+            "status": "running",
+            "node": os.getenv("HOSTNAME", "UNDEFINED"),
+        }):
+            mylog(f"Job {jobid} is skipped")
+            records.pop(jobid, None)
+            cleanup()
+            return
 
         # Run the job
         status = os.system(f"{pbsenv} && {command}")
@@ -269,11 +396,13 @@ async def main():
         wallclock = round(t2 - t1, 2)
 
         # Update job info: finished
-        ji["exit_code"] = status >> 8
-        ji["finished"] = t2
-        ji["status"] = "finished"
-        ji["wallclock"] = wallclock
-        await jobinfo(jobid, ji)
+        await jobinfo(jobid, ["running"], {
+            "exit_code": status >> 8,
+            "finished": t2,
+            "status": "finished",
+            "wallclock": wallclock,
+        })
+        records.pop(jobid, None)
 
         mylog(
             f"Job {jobid} exited with status {status} and the elapsed wallclock time was {wallclock} seconds")
@@ -322,21 +451,33 @@ async def main():
 
         mylog(f"Processing {jobid} is completed")
 
-        if os.path.isfile(nodefile):
-            os.unlink(nodefile)
-
-        if os.path.isdir(tmpdir):
-            rmtree(tmpdir)
-
-        if os.path.isdir(sandbox):
-            rmtree(sandbox)
+        cleanup()
+
+    # Create a pull-based consumer on every shard. Each worker has a home
+    # shard it polls first, the others are visited in turn to steal work
+    # whenever the home shard runs dry.
+    subs = []
+    for subject, sname in subjects:
+        sub = await js.pull_subscribe(subject, consumer, stream=sname)
+        subs.append((sname, sub))
+    home = zlib.crc32(os.getenv("HOSTNAME", socket.gethostname()).encode()) % len(subs)
+    subs = subs[home:] + subs[:home]
+    timeout = 10 if 1 == len(subs) else 1
+
+    async def fetch():
+        # Home shard first, then the others in turn to steal work, each
+        # visit being a single short pull request
+        for i, (sname, sub) in enumerate(subs):
+            try:
+                return sname, await sub.fetch(1, timeout if 0 == i else 0.2)
+            except nats.errors.TimeoutError:
+                continue
+        raise nats.errors.TimeoutError
 
-    # Create a pull-based consumer
-    sub = await js.pull_subscribe(args.queue, consumer, stream=sname)
     jobs = 0
     while True:
         try:
-            msgs = await sub.fetch(1, 10)
+            sname, msgs = await fetch()
         except nats.errors.TimeoutError:
             # loop over and fetch again
             continue